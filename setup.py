@@ -19,9 +19,11 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Development Status :: 1 - Alpha',
         'Environment :: Web Environment',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5'
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9'
     ],
+    python_requires='>=3.7',
     install_requires=[
         'publicsuffixlist'
     ],
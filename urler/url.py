@@ -5,22 +5,187 @@ A module for URL-building/parsing/manipulating.
 """
 
 import re
-import codecs
-import doctest
 import urllib.parse
+import weakref
 
 from copy import copy
-from operator import attrgetter
-from collections import Iterable, OrderedDict
+from encodings import idna
+from functools import lru_cache
+from collections.abc import Iterable
 
 # For publicsuffix utilities
 from publicsuffixlist import PublicSuffixList
 
 __all__ = ('URL',)
 
-PSL = PublicSuffixList()
+# Loading the suffix list takes a while, so it is only done once a host
+# is actually split.
+_PSL = None
+
+
+def _get_psl():
+    global _PSL
+    if _PSL is None:
+        _PSL = PublicSuffixList()
+    return _PSL
+
+
+# Hosts repeat heavily, so the suffix list is walked once per host string
+# and every part of the host is derived from those two lookups.
+@lru_cache(maxsize=4096)
+def _split_host(host):
+    psl = _get_psl()
+    pld = psl.privatesuffix(host) or ''
+    tld = psl.publicsuffix(host) or ''
+    subdomain = pld and host[:-len(pld)].strip('.')
+    domain = tld and pld[:-len(tld)].strip('.')
+    return subdomain, domain, pld, tld
+
+
+@lru_cache(maxsize=4096)
+def _to_ascii_host(host):
+    # ToASCII per label, as the idna codec does, minus the codec dispatch;
+    # ASCII labels, 'xn--' ones included, come out of it unchanged.
+    return '.'.join(
+        label if label.isascii() else idna.ToASCII(label).decode('ascii')
+        for label in idna.dots.split(host)
+    )
+
 
-IDNA = codecs.lookup('idna')
+@lru_cache(maxsize=4096)
+def _to_unicode_host(host):
+    # Only labels with the ACE prefix have anything to decode.
+    return '.'.join(
+        idna.ToUnicode(label) if label.startswith('xn--') else label
+        for label in host.split('.')
+    )
+
+
+def _join_labels(*labels):
+    # Empty parts, such as a missing subdomain, add no stray dot.
+    return '.'.join([label for label in labels if label])
+
+
+def _urlparse(url):
+    # The same six parts urllib.parse.urlparse gives, from one match for
+    # plain printable ASCII. Anything else, such as spaces or controls it
+    # strips or brackets it validates, is left to urllib.
+    match = URL_RE.match(url)
+    if match is None:
+        return urllib.parse.urlparse(url)
+    scheme, netloc, path, query, fragment = match.groups('')
+    scheme = scheme.lower()
+    params = ''
+    if ';' in path and scheme in urllib.parse.uses_params:
+        # Only the last path segment carries params.
+        i = path.find(';', path.rfind('/') + 1)
+        if i >= 0:
+            path, params = path[:i], path[i + 1:]
+    return scheme, netloc, path, params, query, fragment
+
+
+def _split_netloc(netloc):
+    # The username, password, hostname and port a urllib parse result
+    # reports, worked out in one go instead of re-splitting the netloc for
+    # each of those properties.
+    userinfo, _, hostinfo = netloc.rpartition('@')
+    username, _, password = userinfo.partition(':')
+    _, bracket, bracketed = hostinfo.partition('[')
+    if bracket:
+        host, _, port = bracketed.partition(']')
+        _, _, port = port.partition(':')
+    else:
+        host, _, port = hostinfo.partition(':')
+    # The zone of a scoped IPv6 address keeps its case.
+    host, percent, zone = host.partition('%')
+    host = host.lower() + percent + zone
+    return username, password, host, _normalize_port(port)
+
+
+def _normalize_port(port):
+    # The port as urllib reports it, without leading zeros and with 0 as
+    # no port at all.
+    if not port:
+        return ''
+    if not (port.isdigit() and port.isascii()):
+        raise ValueError('Port could not be cast to integer value as {!r}'.format(port))
+    port = int(port)
+    if port > 65535:
+        raise ValueError('Port out of range 0-65535')
+    return str(port or '')
+
+
+def _parse_qs(string, separator='&'):
+    # Split like urllib.parse.parse_qs, dropping blank values, but keep
+    # names and values as they are written: decoding is left to
+    # URL.unescape(). Query strings split on '&' only, as parse_qs does
+    # since Python 3.9.2; path params pass ';'.
+    params = {}
+    if not string:
+        return params
+    for pair in string.split(separator):
+        name, _, value = pair.partition('=')
+        if value:
+            values = params.get(name)
+            if values is None:
+                params[name] = [value]
+            else:
+                values.append(value)
+    return params
+
+
+def _unquote(string):
+    # Same result as urllib.parse.unquote, but the decoded chunks are
+    # collected in a list and joined once.
+    if '%' not in string:
+        return string
+    chunks = string.encode('utf-8').split(b'%')
+    decoded = [chunks[0]]
+    for chunk in chunks[1:]:
+        byte = UNQUOTED_PAIRS.get(chunk[:2])
+        if byte is None:
+            decoded.append(b'%')
+            decoded.append(chunk)
+        else:
+            decoded.append(byte)
+            decoded.append(chunk[2:])
+    return b''.join(decoded).decode('utf-8', 'replace')
+
+
+def _normalize_path(path):
+    # Drop empty and '.' segments and resolve '..' against the segments
+    # seen so far, keeping the leading and trailing slashes.
+    if '//' not in path and '/.' not in path and not path.startswith('.'):
+        return path
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment and segment != '.':
+            segments.append(segment)
+    normalized = '/'.join(segments)
+    if path.startswith('/'):
+        normalized = '/' + normalized
+    if segments and path.endswith('/'):
+        normalized += '/'
+    return normalized
+
+
+# RFC 3986 appendix B, split the way urllib.parse.urlsplit does, for URLs
+# made only of printable ASCII other than brackets. Prefixes that Python
+# versions disagree on being a scheme, one not starting with a letter
+# ('0:', '+:x') or one followed only by digits ('host:80'), are left to
+# urllib too, so the result always matches the running urlparse.
+URL_RE = re.compile(r'''
+    (?=[!-Z\\^-~]*\Z)
+    (?![0-9+.-][A-Za-z0-9+.-]*:|[A-Za-z][A-Za-z0-9+.-]*:[0-9]+\Z)
+    (?:([A-Za-z][A-Za-z0-9+.-]*):)?
+    (?://([^/?#]*))?
+    ([^?#]*)
+    (?:\?([^#]*))?
+    (?:\#(.*))?
+''', re.VERBOSE)
 
 DEFAULT_PORTS = {
     'ftp': '21',
@@ -29,80 +194,232 @@ DEFAULT_PORTS = {
     'https': '443'
 }
 
+# All spellings of a two-digit hex escape mapped to the byte value.
+HEX_PAIRS = {
+    (a + b).encode('ascii'): int(a + b, 16)
+    for a in '0123456789abcdefABCDEF'
+    for b in '0123456789abcdefABCDEF'
+}
+
+UNQUOTED_PAIRS = {pair: bytes((byte,)) for pair, byte in HEX_PAIRS.items()}
+
+# Answers of _Params._is_collection for the value types it sees the most.
+COLLECTION_TYPES = {
+    str: False,
+    int: False,
+    float: False,
+    list: True,
+    tuple: True,
+    set: True,
+    frozenset: True,
+    dict: True
+}
+
+# _is_collection answers for the types missing above, such as generators,
+# dict views or custom iterables. The types are held weakly, so classes
+# created at runtime can still be collected.
+_collection_fallback = weakref.WeakKeyDictionary()
+
 
 class _Params:
 
-    __slots__ = ('_params',)
+    __slots__ = ('_params', '_count', '_version', '_separator')
 
-    def __init__(self, params):
-        self._params = OrderedDict(urllib.parse.parse_qs(params))
+    def __init__(self, params, separator='&'):
+        self._separator = separator
+        self._params = _parse_qs(params, separator)
+        self._count = sum(map(len, self._params.values()))
+        # Bumped by every mutation, so owners can tell a changed params apart
+        # from the one they cached something for.
+        self._version = 0
 
     def __eq__(self, other):
         if isinstance(other, str):
-            _other = self.__class__(other)
-        elif isinstance(other, self.__class__):
-            _other = copy(other)
-        else:
+            other = self.__class__(other, self._separator)
+        elif not isinstance(other, self.__class__):
             return False
 
-        _self = copy(self)
-        _self.sort()
-        _other.sort()
-
-        return _self.to_str() == _other.to_str()
+        # Dict equality ignores the order of names but not the order of
+        # the values under each name, which is what sorting used to give.
+        return self._params == other._params
 
     def __copy__(self):
-        return self.__class__(self.to_str())
+        other = self.__class__.__new__(self.__class__)
+        other._params = {name: list(values) for name, values in self._params.items()}
+        other._count = self._count
+        other._version = self._version
+        other._separator = self._separator
+        return other
+
+    def __len__(self):
+        return self._count
 
     def filter_by(self, predicate):
-        params = OrderedDict()
+        params = {}
+        count = 0
         for name, values in self._params.items():
-            for value in values:
-                if predicate(name, value):
-                    params.setdefault(name, []).append(value)
+            kept = [value for value in values if predicate(name, value)]
+            if kept:
+                params[name] = kept
+                count += len(kept)
         self._params = params
+        self._count = count
+        self._version += 1
 
     def sort(self, key=None):
-        self._params = OrderedDict(sorted(self._params.items(), key=key))
+        if key is None:
+            # Names are unique, so sorting them alone gives the same order
+            # without building a list of (name, values) tuples.
+            params = self._params
+            self._params = {name: params[name] for name in sorted(params)}
+        else:
+            self._params = dict(sorted(self._params.items(), key=key))
+        self._version += 1
 
     def get(self, name):
-        return self._params[name]
+        # A copy, so changing it cannot bypass the version counter.
+        return list(self._params[name])
 
     def add(self, name, value):
-        if self._is_collection(value):
-            self._params.setdefault(name, []).extend(value)
-        else:
-            self._params.setdefault(name, []).append(value)
+        self.add_many(((name, value),))
+
+    def add_many(self, pairs):
+        params = self._params
+        is_collection = self._is_collection
+        count = self._count
+        for name, value in pairs:
+            values = list(value) if is_collection(value) else [value]
+            if not values:
+                # An empty list under a name would make params that write
+                # out the same compare unequal.
+                continue
+            current = params.get(name)
+            if current is None:
+                params[name] = values
+            else:
+                current.extend(values)
+            count += len(values)
+        self._count = count
+        self._version += 1
 
     def set(self, name, value):
-        if self._is_collection(value):
-            self._params[name] = list(value)
-        else:
-            self._params[name] = [value]
+        self.set_many(((name, value),))
+
+    def set_many(self, pairs):
+        params = self._params
+        is_collection = self._is_collection
+        count = self._count
+        for name, value in pairs:
+            values = list(value) if is_collection(value) else [value]
+            if values:
+                current = params.get(name)
+                params[name] = values
+                count += len(values)
+            else:
+                # No values means no name, as for add_many.
+                current = params.pop(name, None)
+            if current is not None:
+                count -= len(current)
+        self._count = count
+        self._version += 1
 
     def remove(self, name, value=None):
-        if self._is_collection(name) and self._is_collection(value):
-            self.remove_by(lambda k, v: k in name and v in value)
-        elif self._is_collection(name) and value is not None:
-            self.remove_by(lambda k, v: k in name and v == value)
-        elif self._is_collection(name):
-            self.remove_by(lambda k, _: k in name)
-        elif self._is_collection(value):
-            self.remove_by(lambda k, v: k == name and v in value)
-        elif value is not None:
-            self.remove_by(lambda k, v: k == name and v == value)
-        else:
-            self.remove_by(lambda k, _: k == name)
+        self.remove_many(((name, value),))
+
+    def remove_many(self, pairs):
+        # Classify every (name, value) pair up front, then touch only the
+        # names involved instead of filtering every param.
+        drop_names = set()
+        drop_values = {}
+        for name, value in pairs:
+            names = name if self._is_collection(name) else (name,)
+            if value is None:
+                drop_names.update(names)
+                continue
+            values = set(value) if self._is_collection(value) else {value}
+            for key in names:
+                drop_values.setdefault(key, set()).update(values)
+
+        params = self._params
+        count = self._count
+        for name in drop_names:
+            current = params.pop(name, None)
+            if current is not None:
+                count -= len(current)
+        for name, values in drop_values.items():
+            current = params.get(name)
+            if current is None:
+                continue
+            kept = [value for value in current if value not in values]
+            count -= len(current) - len(kept)
+            if kept:
+                params[name] = kept
+            else:
+                del params[name]
+        self._count = count
+        self._version += 1
+
+    def map(self, func):
+        # Rewrite every name and value without a serialise/parse round trip.
+        # Names that become equal are merged, as parsing them would do.
+        params = {}
+        for name, values in self._params.items():
+            values = [func(str(value)) for value in values]
+            name = func(str(name))
+            current = params.get(name)
+            if current is None:
+                params[name] = values
+            else:
+                current.extend(values)
+        self._params = params
+        self._version += 1
 
     def remove_by(self, predicate):
         self.filter_by(lambda *args: not predicate(*args))
 
     def to_str(self):
-        return urllib.parse.urlencode(self._params, doseq=True, quote_via=lambda a, *_: a)
+        if not self._count:
+            return ''
+        try:
+            return self._join()
+        except TypeError:
+            # Non-string names or values, e.g. numbers passed to add(),
+            # are written with str() as urlencode would have done.
+            return self._separator.join([
+                str(name) + '=' + str(value)
+                for name, values in self._params.items()
+                for value in values
+            ])
+
+    def _join(self):
+        # Raises TypeError unless every name and value is a string.
+        return self._separator.join([
+            name + '=' + value
+            for name, values in self._params.items()
+            for value in values
+        ])
+
+    def _is_clean(self, safe_bytes):
+        # True when every name and value is a string made of safe bytes
+        # only, so mapping an escape over them would change nothing.
+        try:
+            string = self._join()
+        except TypeError:
+            return False
+        return not string.encode('utf-8').translate(None, safe_bytes)
 
     @staticmethod
     def _is_collection(value):
-        return not isinstance(value, str) and isinstance(value, Iterable)
+        kind = type(value)
+        result = COLLECTION_TYPES.get(kind)
+        if result is None:
+            result = _collection_fallback.get(kind)
+            if result is None:
+                # The answer only depends on the type, so the ABC check runs
+                # once per type rather than per call.
+                result = not isinstance(value, str) and isinstance(value, Iterable)
+                _collection_fallback[kind] = result
+        return result
 
 
 class URL:
@@ -112,7 +429,7 @@ class URL:
     __slots__ = (
         'scheme', 'username', 'password', 'host', 'port',
         '_inferred_port', 'path', 'params', 'query',
-        'fragment'
+        'fragment', '_host_cache', '_canonical', '_string'
     )
 
     # From http://www.ietf.org/rfc/rfc3986.txt
@@ -128,28 +445,32 @@ class URL:
     FRAGMENT = PCHAR + "/?"
     USERINFO = UNRESERVED + SUB_DELIMS + ":"
 
-    PERCENT_ESCAPING_RE = re.compile('(%([a-fA-F0-9]{2})|.)', re.S)
-
     def __init__(self, url, **kwargs):
         """
         >>> URL('http://example.com', path='/path').to_str()
         'http://example.com/path'
+        >>> URL('http://example.com/p;a=1;b=2?q=a;b').to_str()
+        'http://example.com/p;a=1;b=2?q=a;b'
         """
-        parsed = urllib.parse.urlparse(url)
+        scheme, netloc, path, params, query, fragment = _urlparse(url)
 
-        self.scheme = parsed.scheme or ''
-        self.host = parsed.hostname or ''
-        self.port = str(parsed.port or '')
-        self.path = parsed.path
-        self.params = _Params(parsed.params or '')
-        self.query = _Params(parsed.query or '')
-        self.fragment = parsed.fragment or ''
-        self.username = parsed.username or ''
-        self.password = parsed.password or ''
+        self.scheme = scheme
+        self.username, self.password, self.host, self.port = _split_netloc(netloc)
+        self.path = path
+        self.params = _Params(params, ';')
+        self.query = _Params(query)
+        self.fragment = fragment
 
         # For future comparsion
         self._inferred_port = self.port or self.scheme and DEFAULT_PORTS.get(self.scheme)
 
+        # (host, host parts) of the last suffix list lookup
+        self._host_cache = None
+        # (state, generalized copy) of the last comparison
+        self._canonical = None
+        # (state, string) of the last to_str() call
+        self._string = None
+
         if kwargs:
             self.update(**kwargs)
 
@@ -175,50 +496,171 @@ class URL:
         if query is not None:
             self.query = _Params(query)
         if params is not None:
-            self.params = _Params(params)
+            self.params = _Params(params, ';')
         if fragment is not None:
             self.fragment = fragment
         return self
 
     def __copy__(self):
-        return self.__class__(self.to_str())
+        # Plain stores are about twice as fast as a setattr loop over the
+        # slots, and this runs every time a generalized form is rebuilt.
+        other = self.__class__.__new__(self.__class__)
+        other.scheme = self.scheme
+        other.username = self.username
+        other.password = self.password
+        other.host = self.host
+        other.port = self.port
+        other._inferred_port = self._inferred_port
+        other.path = self.path
+        other.params = copy(self.params)
+        other.query = copy(self.query)
+        other.fragment = self.fragment
+        other._host_cache = self._host_cache
+        # Carrying the generalized form over would chain every earlier one
+        # onto the copies __canonical makes, and it could never match anyway.
+        other._canonical = None
+        # The copy has params of its own, which never match the state the
+        # cached string was built from.
+        other._string = None
+        return other
 
     def __eq__(self, other):
         """
         >>> URL('http://example.com') == 'http://example.com:80/'
         True
+        >>> u = URL('http://example.com/?a=1')
+        >>> u == 'http://example.com/?a=1'
+        True
+        >>> u.set_query('a', '9') == 'http://example.com/?a=9'
+        True
         """
         if isinstance(other, str):
-            _other = self.__class__(other)
+            parsed = other = self.__class__(other)
         elif isinstance(other, self.__class__):
-            _other = copy(other)
+            parsed = None
         else:
             return False
 
-        _self = self.__generalize(copy(self))
-        _other = self.__generalize(_other)
+        # Generalizing only lowercases the scheme, and an ASCII host too, so
+        # a difference there settles it before any copy is generalized.
+        if self.scheme.lower() != other.scheme.lower():
+            return False
+        host, other_host = self.host, other.host
+        if host.isascii() and other_host.isascii() and host.lower() != other_host.lower():
+            return False
 
-        attrs = [
-            attrgetter(attr)
-            for attr in (
-                'username', 'password',
-                'scheme', 'host', '_inferred_port',
-                'path', 'params', 'query',
-                'fragment'
-            )
-        ]
+        _other = other.__canonical() if parsed is None else self.__generalize(parsed)
+        _self = self.__canonical()
+
+        return (
+            _self.username == _other.username and
+            _self.password == _other.password and
+            _self.scheme == _other.scheme and
+            _self.host == _other.host and
+            _self._inferred_port == _other._inferred_port and
+            _self.path == _other.path and
+            _self.params == _other.params and
+            _self.query == _other.query and
+            _self.fragment == _other.fragment
+        )
+
+    def __hash__(self):
+        """
+        >>> len({URL('http://example.com'), URL('HTTP://example.com:80/')})
+        1
+        >>> len({URL('/a'), URL('/a/'), URL('/b')})
+        2
 
-        return all(attr(_self) == attr(_other) for attr in attrs)
+        A URL compares equal to a string, but hashes differently from it,
+        so look strings up in a set of URLs as URL(string).
+
+        >>> URL('http://example.com') == 'http://example.com'
+        True
+        >>> 'http://example.com' in {URL('http://example.com')}
+        False
+        """
+        # Built from the fields __eq__ compares. Generalizing escapes every
+        # name and value to a string, so equal params serialise alike.
+        _self = self.__canonical()
+        return hash((
+            _self.username, _self.password,
+            _self.scheme, _self.host, _self._inferred_port,
+            _self.path, _self.params.to_str(), _self.query.to_str(),
+            _self.fragment
+        ))
+
+    def __state(self):
+        # Everything the cached forms are built from: the plain fields with
+        # the params versions, which tell in-place changes, and the params
+        # themselves, which are matched by identity.
+        params, query = self.params, self.query
+        return (
+            (
+                self.scheme, self.username, self.password, self.host,
+                self.port, self.path, self.fragment,
+                params._version, query._version
+            ),
+            params, query
+        )
+
+    @staticmethod
+    def __is_current(cached, state):
+        # _Params equality ignores the order of names, so a replaced params
+        # that compares equal may still write out differently.
+        return (
+            cached is not None and
+            cached[0][1] is state[1] and
+            cached[0][2] is state[2] and
+            cached[0][0] == state[0]
+        )
+
+    def __canonical(self):
+        # Fields are public and params mutate in place, so rather than
+        # relying on every setter to drop the cache it is checked against
+        # the state it was built from.
+        state = self.__state()
+        cached = self._canonical
+        if not self.__is_current(cached, state):
+            cached = self._canonical = (state, self.__generalize(copy(self)))
+        return cached[1]
 
     @staticmethod
     def __generalize(url):
-        url.sort_query()
-        url.sort_params()
-        url.remove_frag()
-        url.add_path('/')
-        url.abspath()
-        url.escape()
-        url.punycode()
+        # What sort_query(), sort_params(), remove_frag(), add_path('/'),
+        # abspath(), escape() and punycode() do, applied to each field once.
+        # Relative URLs have no host to punycode, but still compare and hash.
+        url.host = host = url.host.lower()
+        if not host.isascii():
+            url.host = _to_ascii_host(host)
+
+        # Parsing lowercases the scheme, normalizes the port and infers it,
+        # but setters may have changed them since.
+        url.scheme = scheme = url.scheme.lower()
+        url.port = port = _normalize_port(url.port)
+        url._inferred_port = port or scheme and DEFAULT_PORTS.get(scheme)
+
+        # After a netloc the path is written out with a leading slash.
+        path = url.path
+        if (url.username or url.password or host or port) and path[:1] != '/':
+            path = '/' + path
+
+        percent_encode = URL.percent_encode
+        url.path = percent_encode(_normalize_path(path.rstrip('/') + '/'), URL.PATH)
+        url.username = percent_encode(url.username, URL.USERINFO)
+        url.password = percent_encode(url.password, URL.USERINFO)
+        url.fragment = ''
+
+        def encode(part):
+            return percent_encode(part, URL.QUERY)
+
+        safe_bytes = URL._percent_tables(URL.QUERY)[0]
+        for params in (url.query, url.params):
+            params.sort()
+            if not params._is_clean(safe_bytes):
+                params.map(encode)
+                # Escaping can make names equal or reorder them; sorting
+                # again keeps equal params serialising alike for __hash__.
+                params.sort()
         return url
 
     def __ne__(self, other):
@@ -309,7 +751,7 @@ class URL:
         >>> URL('http://a.example.com').add_subdomain('test').to_str()
         'http://test.a.example.com'
         """
-        self.host = '.'.join((subdomain.strip('.'), self.host))
+        self.host = _join_labels(subdomain.strip('.'), self.host)
         return self
 
     def set_subdomain(self, subdomain):
@@ -317,7 +759,7 @@ class URL:
         >>> URL('http://example.com').set_subdomain('test').to_str()
         'http://test.example.com'
         """
-        self.host = '.'.join((subdomain.strip('.'), self.pld()))
+        self.host = _join_labels(subdomain.strip('.'), self.pld())
         return self
 
     def remove_subdomain(self):
@@ -332,8 +774,10 @@ class URL:
         """
         >>> URL('http://test.example.com').set_domain('a').to_str()
         'http://test.a.com'
+        >>> URL('http://example.com').set_domain('a').to_str()
+        'http://a.com'
         """
-        self.host = '.'.join((self.subdomain(), domain.strip('.'), self.tld()))
+        self.host = _join_labels(self.subdomain(), domain.strip('.'), self.tld())
         return self
 
     def set_pld(self, pld):
@@ -341,7 +785,7 @@ class URL:
         >>> URL('http://test.example.com').set_pld('a.net').to_str()
         'http://test.a.net'
         """
-        self.host = '.'.join((self.subdomain(), pld.strip('.')))
+        self.host = _join_labels(self.subdomain(), pld.strip('.'))
         return self
 
     def set_tld(self, tld):
@@ -352,6 +796,14 @@ class URL:
         self.host = self.host[:-len(self.tld())] + tld.strip('.')
         return self
 
+    def _host_parts(self):
+        # The module-level cache is keyed by host; remembering the last
+        # answer on the URL also skips that lookup while the host stays put.
+        cached = self._host_cache
+        if cached is None or cached[0] != self.host:
+            cached = self._host_cache = (self.host, _split_host(self.host))
+        return cached[1]
+
     def hostname(self):
         """
         Return the hostname of the url.
@@ -368,7 +820,7 @@ class URL:
         >>> URL('http://ru.example.com').subdomain()
         'ru'
         """
-        return self.host and self.host[:-len(self.pld())].strip('.') or ''
+        return self.host and self._host_parts()[0]
 
     def domain(self):
         """
@@ -377,7 +829,7 @@ class URL:
         >>> URL('http://ru.example.com').domain()
         'example'
         """
-        return self.host and self.pld()[:-len(self.tld())].strip('.') or ''
+        return self.host and self._host_parts()[1]
 
     def pld(self):
         """
@@ -386,7 +838,7 @@ class URL:
         >>> URL('http://ru.example.com').pld()
         'example.com'
         """
-        return self.host and PSL.privatesuffix(self.host) or ''
+        return self.host and self._host_parts()[2]
 
     def tld(self):
         """
@@ -395,7 +847,7 @@ class URL:
         >>> URL('http://example.com').tld()
         'com'
         """
-        return self.host and PSL.publicsuffix(self.host) or ''
+        return self.host and self._host_parts()[3]
 
     # Port methods
     # ------------------------------------------------------------------------
@@ -404,6 +856,8 @@ class URL:
         """
         >>> URL('http://example.com').set_port('8080').to_str()
         'http://example.com:8080'
+        >>> URL('http://example.com').set_port('080') == 'http://example.com'
+        True
         """
         self.port = port
         self._inferred_port = port
@@ -428,17 +882,18 @@ class URL:
 
         >>> URL('http://example.com/a///////b///1/../c/d').abspath().to_str()
         'http://example.com/a/b/c/d'
+        >>> URL('http://example.com/../a/./b/').abspath().path
+        '/a/b/'
         """
-        if not self.path.endswith('/'):
-            self.path = urllib.parse.urljoin(self.path + '/', '.').rstrip('/')
-        else:
-            self.path = urllib.parse.urljoin(self.path, '.')
+        self.path = _normalize_path(self.path)
         return self
 
     def set_path(self, path):
         """
         >>> URL('http://example.com/a').set_path('/b').to_str()
         'http://example.com/b'
+        >>> URL('http://example.com').set_path('b') == 'http://example.com/b'
+        True
         """
         self.path = path
         return self
@@ -484,8 +939,15 @@ class URL:
 
     def get_query(self, name):
         """
+        Return a copy of the values of a query param. Changing the list
+        does not change the url, use set_query() or add_query() for that.
+
         >>> URL('http://example.com?a=1').get_query('a')
         ['1']
+        >>> u = URL('http://example.com?a=1')
+        >>> u.get_query('a').append('2')
+        >>> u.to_str()
+        'http://example.com?a=1'
         """
         return self.query.get(name)
 
@@ -500,10 +962,12 @@ class URL:
         >>> u = URL('http://example.com?x=2&x=3&b=0')
         >>> u.set_query({'x': '1', 'a': ['1','2']}).sort_query().to_str()
         'http://example.com?a=1&a=2&b=0&x=1'
+
+        >>> URL('http://example.com/?a=1').set_query('a', []) == 'http://example.com/'
+        True
         """
         if isinstance(mixed, dict):
-            for pair in mixed.items():
-                self.query.set(*pair)
+            self.query.set_many(mixed.items())
         else:
             self.query.set(mixed, value)
         return self
@@ -517,10 +981,12 @@ class URL:
 
         >>> URL('http://example.com?x=1&x=2').add_query({'x': '3', 'b': '0'}).to_str()
         'http://example.com?x=1&x=2&x=3&b=0'
+
+        >>> URL('http://example.com/').add_query('a', []) == 'http://example.com/'
+        True
         """
         if isinstance(mixed, dict):
-            for pair in mixed.items():
-                self.query.add(*pair)
+            self.query.add_many(mixed.items())
         else:
             self.query.add(mixed, value)
         return self
@@ -537,8 +1003,7 @@ class URL:
         'http://example.com?b=2'
         """
         if isinstance(mixed, dict):
-            for pair in mixed.items():
-                self.query.remove(*pair)
+            self.query.remove_many(mixed.items())
         else:
             self.query.remove(mixed, value)
         return self
@@ -564,6 +1029,9 @@ class URL:
 
     def get_param(self, name):
         """
+        Return a copy of the values of a path param. Changing the list
+        does not change the url, use set_params() or add_params() for that.
+
         >>> URL('http://example.com/;a=1').get_param('a')
         ['1']
         """
@@ -582,8 +1050,7 @@ class URL:
         'http://example.com/;a=1;a=2;b=0;x=1'
         """
         if isinstance(mixed, dict):
-            for pair in mixed.items():
-                self.params.set(*pair)
+            self.params.set_many(mixed.items())
         else:
             self.params.set(mixed, value)
         return self
@@ -599,8 +1066,7 @@ class URL:
         'http://example.com/;x=1;x=2;x=3;b=0'
         """
         if isinstance(mixed, dict):
-            for pair in mixed.items():
-                self.params.add(*pair)
+            self.params.add_many(mixed.items())
         else:
             self.params.add(mixed, value)
         return self
@@ -617,8 +1083,7 @@ class URL:
         'http://example.com/;b=2'
         """
         if isinstance(mixed, dict):
-            for pair in mixed.items():
-                self.params.remove(*pair)
+            self.params.remove_many(mixed.items())
         else:
             self.params.remove(mixed, value)
         return self
@@ -662,37 +1127,110 @@ class URL:
         """
         return self.abspath().escape()
 
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _percent_tables(safe_chars):
+        """
+        Build lookup tables for percent_encode: the bytes that pass through
+        untouched, a map from every byte to its literal character or its
+        escape, and a map from every existing escape to its canonical form.
+        """
+        safe = frozenset(safe_chars)
+        # Escaped reserved characters are meaningful, so they stay escaped.
+        decodable = safe.difference(URL.RESERVED)
+        safe_bytes = bytes(
+            byte for byte in range(256)
+            if chr(byte) in safe and byte != 0x25
+        )
+        table = tuple(
+            chr(byte) if chr(byte) in safe else '%{:02X}'.format(byte)
+            for byte in range(256)
+        )
+        escapes = {
+            pair: (
+                chr(byte) if chr(byte) in decodable
+                else '%' + pair.decode('ascii').upper()
+            )
+            for pair, byte in HEX_PAIRS.items()
+        }
+        # Same answers for escapes split out of a str rather than bytes.
+        escapes.update({
+            pair.decode('ascii'): escape for pair, escape in escapes.items()
+        })
+        return safe_bytes, table, escapes
+
     @staticmethod
     def percent_encode(raw, safe_chars):
         """
-        >>> URL.percent_encode('привет мир!', safe=[])
-        'a'
-        """
-        def replacement(match):
-            raw_char = match.group(1)
-            if len(raw_char) == 1:
-                return raw_char if raw_char in safe_chars else '%{:02X}'.format(ord(raw_char))
+        >>> URL.percent_encode('привет мир!', URL.PATH)
+        '%D0%BF%D1%80%D0%B8%D0%B2%D0%B5%D1%82%20%D0%BC%D0%B8%D1%80!'
+        >>> URL.percent_encode('%7e%2f%zz', URL.PATH)
+        '~%2F%25zz'
+        >>> URL.percent_encode('a b', ['a', 'b'])
+        'a%20b'
+        """
+        if not raw:
+            return raw
+        if not isinstance(safe_chars, (str, frozenset)):
+            # The tables are cached per safe set, which needs a hashable key.
+            safe_chars = frozenset(safe_chars)
+        safe_bytes, table, escapes = URL._percent_tables(safe_chars)
+        data = raw.encode('utf-8')
+        # Deleting the safe bytes is a single C pass; nothing left means
+        # there is nothing to escape.
+        if not data.translate(None, safe_bytes):
+            return raw
+        if raw.isascii():
+            # str.translate maps ASCII through the table in C; for other
+            # characters it is slower than indexing the table per byte.
+            if '%' not in raw:
+                return raw.translate(table)
+            chunks = raw.split('%')
+
+            def encode(chunk):
+                return chunk.translate(table)
+        else:
+            if b'%' not in data:
+                return ''.join([table[byte] for byte in data])
+            chunks = data.split(b'%')
+
+            def encode(chunk):
+                return ''.join([table[byte] for byte in chunk])
+
+        encoded = [encode(chunks[0])]
+        for chunk in chunks[1:]:
+            escape = escapes.get(chunk[:2])
+            if escape is None:
+                # A lone '%' is not an escape, so it gets escaped itself.
+                encoded.append(table[0x25])
             else:
                 # Replace any escaped entities with their equivalent if needed.
-                char = chr(int(match.group(2), 16))
-                if (char in safe_chars) and (char not in URL.RESERVED):
-                    return char
-                return raw_char.upper()
-        return URL.PERCENT_ESCAPING_RE.sub(replacement, raw)
+                encoded.append(escape)
+                chunk = chunk[2:]
+            encoded.append(encode(chunk))
+        return ''.join(encoded)
 
     def escape(self):
         """
         Make sure that the path is correctly escaped.
+
+        >>> URL('http://example.com/a b?q=a b&r=%7e').escape().to_str()
+        'http://example.com/a%20b?q=a%20b&r=~'
         """
         self.path = self.percent_encode(self.path, URL.PATH)
         self.username = self.percent_encode(self.username, URL.USERINFO)
         self.password = self.percent_encode(self.password, URL.USERINFO)
 
-        _query = self.percent_encode(self.query.to_str(), URL.QUERY)
-        self.query = _Params(_query)
+        def encode(part):
+            return URL.percent_encode(part, URL.QUERY)
 
-        _params = self.percent_encode(self.params.to_str(), URL.QUERY)
-        self.params = _Params(_params)
+        # '&', ';' and '=' are safe in a query, so one check over the whole
+        # string tells whether the params need to be rebuilt at all.
+        safe_bytes = URL._percent_tables(URL.QUERY)[0]
+        if not self.query._is_clean(safe_bytes):
+            self.query.map(encode)
+        if not self.params._is_clean(safe_bytes):
+            self.params.map(encode)
 
         return self
 
@@ -700,11 +1238,11 @@ class URL:
         """
         Unescape the path.
         """
-        self.path = urllib.parse.unquote(self.path)
-        self.query = _Params(urllib.parse.unquote(self.query.to_str()))
-        self.params = _Params(urllib.parse.unquote(self.params.to_str()))
-        self.username = urllib.parse.unquote(self.username)
-        self.password = urllib.parse.unquote(self.password)
+        self.path = _unquote(self.path)
+        self.query.map(_unquote)
+        self.params.map(_unquote)
+        self.username = _unquote(self.username)
+        self.password = _unquote(self.password)
         return self
 
     def punycode(self):
@@ -717,7 +1255,8 @@ class URL:
         """
         if not self.host:
             raise TypeError('Cannot punycode a relative url {}'.format(repr(self)))
-        self.host = IDNA.encode(self.host)[0].decode('utf-8')
+        if not self.host.isascii():
+            self.host = _to_ascii_host(self.host)
         return self
 
     def unpunycode(self):
@@ -729,7 +1268,8 @@ class URL:
         """
         if not self.host:
             raise TypeError('Cannot unpunycode a relative url {}'.format(repr(self)))
-        self.host = IDNA.decode(self.host.encode('utf-8'))[0]
+        if self.host.startswith('xn--') or '.xn--' in self.host:
+            self.host = _to_unicode_host(self.host)
         return self
 
     # Get a string representation. These methods can't be chained, as they
@@ -739,29 +1279,62 @@ class URL:
     def to_str(self):
         """
         Return a unicode version of this url
-        """
-        netloc = ''
 
-        if self.username:
-            netloc += self.username
+        >>> u = URL('http://example.com/?a=1&b=2')
+        >>> u.to_str()
+        'http://example.com/?a=1&b=2'
+        >>> u.update(query='b=2&a=1').to_str()
+        'http://example.com/?b=2&a=1'
+        """
+        state = self.__state()
+        cached = self._string
+        if not self.__is_current(cached, state):
+            cached = self._string = (state, self.__build_str())
+        return cached[1]
 
-        if self.password:
-            netloc += ':' + self.password
+    def __build_str(self):
+        # Same output as urllib.parse.urlunparse, joined in one go.
+        scheme, path = self.scheme, self.path
+        params = self.params.to_str()
+        parts = []
 
-        if self.host:
-            netloc += (netloc and '@') + self.host
+        if scheme:
+            parts += scheme, ':'
 
-        if self.port:
-            netloc += ':' + self.port
+        userinfo = self.username
+        if self.password:
+            userinfo += ':' + self.password
+
+        host = self.host
+        netloc = userinfo or host or self.port
+        if netloc or (scheme in urllib.parse.uses_netloc and scheme and path[:2] != '//'):
+            parts.append('//')
+            if userinfo:
+                parts.append(userinfo)
+                if host:
+                    parts.append('@')
+            parts.append(host)
+            if self.port:
+                parts += ':', self.port
+            # The params count as part of the path here, as in urlunparse.
+            if (path or params) and path[:1] != '/':
+                parts.append('/')
+
+        parts.append(path)
+
+        if params:
+            parts += ';', params
 
         query = self.query.to_str()
-        params = self.params.to_str().replace('&', ';')
+        if query:
+            parts += '?', query
+
+        if self.fragment:
+            parts += '#', self.fragment
 
-        return urllib.parse.urlunparse((
-            self.scheme, netloc,
-            self.path, params, query,
-            self.fragment))
+        return ''.join(parts)
 
 
 if __name__ == "__main__":
+    import doctest
     doctest.testmod()